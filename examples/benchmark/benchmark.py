@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+Measure garbage collector pauses and peak memory during a churn-heavy
+workload (removing, re-inserting and copying sub-trees), using either strong
+parent references (`NodeTree`/`Node`) or weak parent references
+(`WeakParentNodeTree`/`WeakParentNode`).
+
+Usage:
+
+    python benchmark.py [strong|weak] [--nodes N] [--iterations N]
+
+If no mode is given, each mode is run in a separate process (so the peak
+memory of each mode is measured independently), and the results are printed
+side by side.
+
+Automatic garbage collection is disabled during the workload.  Instead, after
+each step of the workload, the generation that the collector would collect
+given its current counts and thresholds is collected explicitly, and each
+collection is timed.  This way, the reported pauses only include collector
+time (and not the work of the mutations themselves).  Note that each
+collection may cover more allocations than an automatic collection would,
+since collections only run between steps.
+'''
+import sys
+import gc
+import time
+import random
+import resource
+import subprocess
+from argparse import ArgumentParser
+
+from path import path
+
+package_root = path(__file__).abspath().parent.parent.parent
+sys.path.insert(0, package_root)
+
+
+from node_tree.node_tree import NodeTree, Node, WeakParentNodeTree, \
+        WeakParentNode
+
+
+MODES = {'strong': (NodeTree, Node),
+         'weak': (WeakParentNodeTree, WeakParentNode)}
+
+
+def build_tree(tree_class, node_class, node_count, fanout=4):
+    '''
+    Build a tree with approximately `node_count` nodes, where each top-level
+    `Node` is the root of a complete sub-tree with the specified `fanout`.
+    '''
+    top = []
+    count = 0
+    while count < node_count:
+        node = node_class(count)
+        count += 1
+        level = [node]
+        for depth in range(2):
+            next_level = []
+            for parent in level:
+                for i in range(fanout):
+                    child = parent.append_node(node_class(count))
+                    count += 1
+                    next_level.append(child)
+            level = next_level
+        top.append(node)
+    return tree_class(top)
+
+
+def collect_due(pauses):
+    '''
+    Collect the oldest generation whose count exceeds its threshold (i.e.,
+    the generation that the collector would collect automatically), if any,
+    and append the duration of the collection to `pauses`.
+    '''
+    counts = gc.get_count()
+    thresholds = gc.get_threshold()
+    for generation in (2, 1, 0):
+        if counts[generation] > thresholds[generation]:
+            t0 = time.time()
+            gc.collect(generation)
+            pauses.append(time.time() - t0)
+            return
+
+
+def run(mode, node_count, iterations, seed=0):
+    tree_class, node_class = MODES[mode]
+    random.seed(seed)
+    gc.collect()
+    node_tree = build_tree(tree_class, node_class, node_count)
+
+    pauses = []
+    gc.disable()
+    start = time.time()
+    for i in range(iterations):
+        # Move a random top-level sub-tree to a random position.
+        sub_tree = node_tree.remove(node_tree[(random.randrange(
+                len(node_tree.root)), )])
+        collect_due(pauses)
+        sibling = node_tree[(random.randrange(len(node_tree.root)), )]
+        node_tree.insert_after(sibling, sub_tree[0])
+        collect_due(pauses)
+        # Throw away a snapshot of a sub-tree, and of the whole tree.
+        node_tree[random.randrange(len(node_tree))].get_tree()
+        collect_due(pauses)
+        if i % 10 == 0:
+            node_tree.copy()
+            collect_due(pauses)
+    elapsed = time.time() - start - sum(pauses)
+
+    t0 = time.time()
+    unreachable = gc.collect()
+    collect_time = time.time() - t0
+    gc.enable()
+
+    return {'mode': mode,
+            'nodes': len(node_tree),
+            'elapsed': elapsed,
+            'collections': len(pauses),
+            'total_pause': sum(pauses),
+            'max_pause': max(pauses) if pauses else 0,
+            'collect_time': collect_time,
+            'unreachable': unreachable,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+FIELDS = [('nodes', 'nodes', '%d'),
+          ('elapsed', 'churn time, without GC (s)', '%.3f'),
+          ('collections', 'GC collections', '%d'),
+          ('total_pause', 'total GC pause (s)', '%.4f'),
+          ('max_pause', 'max GC pause (s)', '%.4f'),
+          ('collect_time', 'final full collection (s)', '%.4f'),
+          ('unreachable', 'objects left for cyclic GC', '%d'),
+          ('peak_rss_kb', 'peak RSS (kB)', '%d')]
+
+
+def parse_args(args=None):
+    parser = ArgumentParser(description='Measure GC pauses and peak memory '
+                            'of churn-heavy workloads.')
+    parser.add_argument('mode', nargs='?', choices=sorted(MODES))
+    parser.add_argument('--nodes', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=200)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.mode is not None:
+        results = run(args.mode, args.nodes, args.iterations)
+        for name, label, format_ in FIELDS:
+            print '%s\t%s' % (name, format_ % results[name])
+    else:
+        columns = []
+        for mode in sorted(MODES):
+            output = subprocess.check_output([sys.executable, __file__, mode,
+                                              '--nodes', str(args.nodes),
+                                              '--iterations',
+                                              str(args.iterations)])
+            columns.append((mode, dict(line.split('\t')
+                                       for line in output.splitlines())))
+        print '%-28s' % '' + ''.join('%12s' % mode for mode, values in
+                                     columns)
+        for name, label, format_ in FIELDS:
+            print '%-28s' % label + ''.join('%12s' % values[name]
+                                            for mode, values in columns)
@@ -8,11 +8,31 @@ except ImportError:
     import StringIO
 import logging
 import copy
+import operator
+import bisect
+import hashlib
+import functools
+import threading
+import weakref
+from itertools import izip_longest
+from collections import deque, namedtuple
 
 from jinja2 import Template
 from path import path
 
 
+# Name of the aggregate holding the structural hash of each sub-tree.
+_HASH_AGGREGATE = '_hash'
+
+
+def _identity(item):
+    return item
+
+
+def _one(item):
+    return 1
+
+
 class NodeTree(object):
     r'''
     An instance of this class represents a flat top-level tree structure.
@@ -50,11 +70,35 @@ class NodeTree(object):
 
 
     Nodes can be grouped and ungrouped using the methods with corresponding names.
+
+    An edit script that transforms one tree into another can be computed using
+    `diff()`, and applied as a single batched mutation using `apply_patch()`.
+
+    Per-subtree aggregates (e.g., node counts, or sums of a value derived
+    from `Node.item`) can be registered using `register_aggregate()`.  See
+    `Aggregate` for details.
+
+    A structural hash of each sub-tree can be maintained by calling
+    `enable_hashing()`, which makes comparing trees and detecting changes to
+    a sub-tree cheap.
+
+    By default, each `Node` holds a strong reference to its parent, so every
+    tree is a reference cycle that can only be freed by the cyclic garbage
+    collector.  Use `WeakParentNodeTree` (and `WeakParentNode`) to link each
+    `Node` to its parent using a weak reference instead, so discarded trees
+    and sub-trees are freed as soon as they are no longer referenced.
+
+    Consumers that should not run inside a mutation may subscribe to a
+    buffered stream of `Change` records using `changes()`, instead of
+    overriding the `on_*` callback methods.  See `ChangeFeed` for details.
     '''
     def __init__(self, children=None):
         self._ungroup_in_progress = False
         self._group_in_progress = False
-        self.root = Node(None)
+        self._aggregates = {}
+        self._hash_params = None
+        self._feeds = []
+        self.root = self.node_class(None)
         self._reset_index()
         if children is not None:
             try:
@@ -73,6 +117,117 @@ class NodeTree(object):
             msg = s.getvalue()
         return msg
 
+    def __getstate__(self):
+        '''
+        Return the state of the tree for pickling and copying.  The indexes
+        are left out, since they are rebuilt from the `Node` instances by
+        `__setstate__()` (see `Node.__getstate__()` and
+        `Node.__deepcopy__()`).
+        '''
+        state = self.__dict__.copy()
+        for name in ('_node_to_id_map', '_id_to_node_map',
+                '_node_to_position_map'):
+            del state[name]
+        # Subscribers are bound to this instance, so they are not carried over
+        # to copies.
+        state['_feeds'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reindex()
+
+    def changes(self, maxlen=1024, policy='coalesce'):
+        '''
+        Subscribe to the mutations of this tree.  Return a `ChangeFeed`
+        instance, which buffers up to `maxlen` `Change` records until they
+        are consumed.  `policy` selects what happens when the buffer is full
+        (see `ChangeFeed`).
+
+        Mutations only append records to the buffer of each subscriber, so
+        they return immediately regardless of how slow the consumers are.
+
+        >>> node_tree = NodeTree()
+        >>> feed = node_tree.changes()
+        >>> for letter in 'AB': node_tree.append_node(Node(letter))#doctest: +ELLIPSIS
+        <...>
+        >>> node_tree.group([node_tree[0], node_tree[1]])
+        >>> node_tree.set_item(node_tree[1], 'C')
+        >>> for change in feed.drain(): print change.kind, change.path
+        appended (0,)
+        inserted (1,)
+        grouped (0,)
+        updated (0, 0)
+
+        Records hold snapshots, so later mutations do not leak into records
+        that are still buffered:
+
+        >>> node_tree.append_child(node_tree[1], Node('C.A'))
+        >>> node_tree.append_child(node_tree[1], Node('C.B'))
+        >>> [len(change.data) for change in feed.drain()]
+        [0, 0]
+        >>> feed.close()
+        '''
+        feed = ChangeFeed(self, maxlen=maxlen, policy=policy)
+        self._feeds.append(feed)
+        return feed
+
+    def _publish(self, kind, path, data=None):
+        '''
+        Append a `Change` record to the buffer of each subscriber.  `data`
+        must not be modified by later mutations of the tree, since it may be
+        consumed long after this call (i.e., it should be a copy of any
+        `Node` in the tree).
+        '''
+        if not self._feeds:
+            return
+        change = Change(kind, path, data)
+        # Feeds may close themselves on overflow, so iterate over a copy.
+        for feed in list(self._feeds):
+            feed._put(change)
+
+    def __eq__(self, other):
+        '''
+        Two `NodeTree` instances are equal if they have the same structure,
+        and the items of corresponding `Node` instances are equal.
+
+        If hashing is enabled on both trees with the same parameters, and the
+        hashes are consistent with the equality of items (see
+        `enable_hashing()`), trees with different hashes are reported as
+        unequal without walking them.
+        '''
+        if self is other:
+            return True
+        if not isinstance(other, NodeTree):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        if (self.hashing_enabled and other.hashing_enabled and
+                self._hash_params == other._hash_params and
+                self._hash_implies_equality() and
+                self.subtree_hash() != other.subtree_hash()):
+            return False
+        # Equal hashes may still be a collision, so confirm by comparing the
+        # trees.  Both trees are visited in the same order, so they have the
+        # same structure if each pair of `Node` instances has the same number
+        # of children.
+        for a, b in izip_longest(self.root.iter_subtree(),
+                other.root.iter_subtree()):
+            if a is None or b is None:
+                return False
+            elif len(a.children) != len(b.children) or a.item != b.item:
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    # Instances are mutable, so they must not be hashable.
+    __hash__ = None
+
     def single_root_as_node(self):
         '''
         If this `NodeTree` has exactly one top-level `Node`, return a copy of
@@ -94,7 +249,7 @@ class NodeTree(object):
             return
         self._ungroup_in_progress = True
         try:
-            root_paths = [self._node_to_path_map[n] for n in nodes]
+            root_paths = [self._node_path(n) for n in nodes]
             for root in nodes:
                 # if the parent is not set, then this node was already
                 # removed by removing a parent (or grandparent, etc.)
@@ -118,8 +273,8 @@ class NodeTree(object):
             return
         self._group_in_progress = True
         try:
-            node_paths, nodes = zip(*sorted([(self._node_to_path_map[
-                    node], node) for node in nodes]))
+            node_paths, nodes = zip(*sorted([(self._node_path(node), node)
+                    for node in nodes]))
             root = nodes[0]
             removed = [self.remove(node)[0]
                     for node in nodes[len(nodes) - 1:0:-1]]
@@ -129,6 +284,297 @@ class NodeTree(object):
         finally:
             self._group_in_progress = False
 
+    def register_aggregate(self, name, aggregate):
+        '''
+        Register an `Aggregate` under `name`.  The aggregate value is computed
+        once for every `Node` in the tree and cached on each `Node`.  From then
+        on, the cached values are only updated along the ancestor path of
+        each `Node` affected by a mutation (`append_child`, `insert_*`,
+        `remove`, `group`, `ungroup`, and `set_item`).
+
+        For example:
+
+        >>> node_tree = NodeTree([Node(1), Node(2)])
+        >>> node_tree.register_aggregate('count', Aggregate.count())
+        >>> node_tree.register_aggregate('total', Aggregate.sum())
+        >>> node_tree.append_child(node_tree[1], Node(10))
+        >>> node_tree.append_child(node_tree[1], Node(20))
+        >>> node_tree.aggregate('count'), node_tree.aggregate('total')
+        (4, 33)
+        >>> node_tree.aggregate('total', node_tree[1])
+        32
+        >>> node_tree.set_item(node_tree[1, 0], 100)
+        >>> node_tree.aggregate('total', node_tree[1])
+        122
+        >>> removed = node_tree.remove(node_tree[1, 1])
+        >>> node_tree.aggregate('count'), node_tree.aggregate('total')
+        (3, 103)
+        '''
+        self._aggregates[name] = aggregate
+        # Reversed depth-first pre-visit order visits every `Node` after all of
+        # its descendents, so children are always computed before parents.
+        for node in reversed(list(self.root.iter_subtree())):
+            self._update_aggregate(name, aggregate, node)
+
+    def unregister_aggregate(self, name):
+        '''
+        Stop maintaining the aggregate registered under `name`, and drop the
+        corresponding cached values.
+        '''
+        del self._aggregates[name]
+        for node in self.root.iter_subtree():
+            node._aggregates.pop(name, None)
+
+    def aggregate(self, name, node=None):
+        '''
+        Return the cached value of the aggregate registered under `name` for
+        the sub-tree rooted at `node`.  If no `Node` is given, return the value
+        for the whole tree.
+        '''
+        if node is None:
+            node = self.root
+        return node._aggregates[name]
+
+    @property
+    def hashing_enabled(self):
+        return _HASH_AGGREGATE in self._aggregates
+
+    def enable_hashing(self, digest=hashlib.sha1, key=None):
+        '''
+        Maintain a structural (Merkle) hash for each sub-tree, covering the
+        hash of each item along with the order of the children.  The hashes
+        are cached on each `Node`, and only updated along the ancestor path of
+        each mutated `Node` (see `register_aggregate()`).
+
+        By default, hashes are SHA-1 digests of `key(item)` (`repr` if no
+        `key` is given), so they are stable across processes and machines,
+        and may be stored (e.g., to deduplicate identical sub-trees).
+        `digest` may be any `hashlib` constructor, and `key` must return a
+        string that identifies the item.
+
+        Pass `digest=hash` to use the built-in `hash()` of `key(item)` (the
+        item itself if no `key` is given) instead.  This is faster, but the
+        hashes are only comparable within a single process.
+
+        If `key` is given, it must return equal values for items that compare
+        equal, since `==` then reports trees with different hashes as unequal
+        without comparing their items (see `__eq__()`).  The same holds for
+        `digest=hash` without a `key`.  Otherwise, `repr` may differ for equal
+        items, so the hashes are not used by `==`:
+
+        >>> d = NodeTree([Node(1)])
+        >>> e = NodeTree([Node(1.0)])
+        >>> d.enable_hashing()
+        >>> e.enable_hashing()
+        >>> d.subtree_hash() == e.subtree_hash(), d == e
+        (False, True)
+
+        >>> a = NodeTree([Node('A'), Node('B')])
+        >>> a.enable_hashing()
+        >>> b = a.copy()
+        >>> b.subtree_hash() == a.subtree_hash(), b == a
+        (True, True)
+        >>> before = b.subtree_hash(b[1])
+        >>> b.append_child(b[1], Node('B.A'))
+        >>> b.subtree_hash(b[1]) == before, b == a
+        (False, False)
+        >>> b.subtree_hash(b[0]) == a.subtree_hash(a[0])
+        True
+        >>> c = NodeTree([Node('A')])
+        >>> c.enable_hashing()
+        >>> c.subtree_hash().encode('hex')
+        '53d1eb228678e7b67fe5026a97db80eba2fd5449'
+        '''
+        params = (digest, key)
+        if self.hashing_enabled and self._hash_params == params:
+            return
+        self._hash_params = params
+        self.register_aggregate(_HASH_AGGREGATE, Aggregate.merkle(digest,
+                key))
+
+    def _hash_implies_equality(self):
+        '''
+        Return `True` if equal items are guaranteed to have equal hashes with
+        the current hashing parameters, i.e., if trees with different hashes
+        are guaranteed to be unequal.
+        '''
+        digest, key = self._hash_params
+        return digest is hash or key is not None
+
+    def disable_hashing(self):
+        if self.hashing_enabled:
+            self.unregister_aggregate(_HASH_AGGREGATE)
+            self._hash_params = None
+
+    def subtree_hash(self, node=None):
+        '''
+        Return the structural hash of the sub-tree rooted at `node`.  If no
+        `Node` is given, return the hash of the whole tree.  Hashing must be
+        enabled (see `enable_hashing()`).
+
+        Identical sub-trees have equal hashes, so the hash may be used to
+        detect changes to a sub-tree, or to find duplicate sub-trees.
+        '''
+        if not self.hashing_enabled:
+            raise ValueError, 'Hashing is not enabled.  See '\
+                    '`NodeTree.enable_hashing()`.'
+        return self.aggregate(_HASH_AGGREGATE, node)
+
+    def set_item(self, node, item):
+        '''
+        Set the item of `node` to `item`, updating all registered aggregates
+        along the ancestor path of `node`, and notifying subscribers (see
+        `on_node_updated()` and `changes()`).
+
+        Note that if an item is modified in place, this method should be
+        called as `set_item(node, node.item)` to refresh the aggregates:
+
+        >>> node_tree = NodeTree([Node({'w': 1}), Node({'w': 2})])
+        >>> node_tree.register_aggregate('total', Aggregate.sum(
+        ...         lambda item: item['w']))
+        >>> node_tree.register_aggregate('max', Aggregate.max(
+        ...         lambda item: item['w']))
+        >>> node = node_tree[0]
+        >>> node.item['w'] = 10
+        >>> node_tree.set_item(node, node.item)
+        >>> node_tree.aggregate('total'), node_tree.aggregate('max')
+        (12, 10)
+        '''
+        node.item = item
+        self._set_item_aggregates(node)
+        self._on_node_updated(self._node_path(node), item)
+
+    def _update_aggregate(self, name, aggregate, node):
+        '''
+        Recompute the value of `aggregate` for `node` from the item of `node`
+        and the cached values of its children.
+        '''
+        if node is self.root:
+            # The root `Node` is not part of the tree contents, so it only
+            # contributes the values of its children.
+            value = aggregate.identity
+        else:
+            value = aggregate.leaf(node.item)
+        for child in node.children:
+            value = aggregate.combine(value, child._aggregates[name])
+        node._aggregates[name] = value
+
+    def _propagate_aggregates(self, node, old_values, new_values,
+            refold=True):
+        '''
+        Update the registered aggregates of `node` and each of its ancestors,
+        after a contribution to the value of `node` changed from `old_values`
+        to `new_values` (dictionaries keyed by aggregate name).
+
+        For aggregates with an `inverse`, the change is applied as a delta to
+        each ancestor, so the cost is proportional to the depth of `node`.
+        Other aggregates are recomputed from the children of each ancestor,
+        unless `refold` is `False` (see `_refold_aggregates()`).
+        '''
+        for name, aggregate in self._aggregates.iteritems():
+            ancestor = node
+            if aggregate.inverse is None:
+                if not refold:
+                    continue
+                while ancestor is not None:
+                    self._update_aggregate(name, aggregate, ancestor)
+                    ancestor = ancestor.parent
+                continue
+            old_value = old_values[name]
+            new_value = new_values[name]
+            while ancestor is not None:
+                ancestor._aggregates[name] = aggregate.combine(
+                        aggregate.inverse(ancestor._aggregates[name],
+                                old_value), new_value)
+                ancestor = ancestor.parent
+
+    def _refold_aggregates(self, nodes):
+        '''
+        Recompute the registered aggregates without an `inverse` for each of
+        `nodes` and their ancestors.  Each `Node` is only recomputed once,
+        after all of its descendents.
+        '''
+        aggregates = [(name, aggregate) for name, aggregate in
+                self._aggregates.iteritems() if aggregate.inverse is None]
+        if not aggregates:
+            return
+        depths = {}
+        for node in nodes:
+            chain = []
+            while node is not None and node not in depths:
+                chain.append(node)
+                node = node.parent
+            depth = -1 if node is None else depths[node]
+            for n in reversed(chain):
+                depth += 1
+                depths[n] = depth
+        for node in sorted(depths, key=depths.get, reverse=True):
+            for name, aggregate in aggregates:
+                self._update_aggregate(name, aggregate, node)
+
+    def _identity_aggregates(self):
+        return dict((name, aggregate.identity)
+                for name, aggregate in self._aggregates.iteritems())
+
+    def _compute_subtree_aggregates(self, node):
+        '''
+        Compute the registered aggregates of every `Node` in the sub-tree
+        rooted at `node`, which is not part of the tree yet.  This is done
+        before `node` is linked into the tree, so the tree is left unchanged
+        if an aggregate fails (e.g., for an item that cannot be hashed).
+        '''
+        if not self._aggregates:
+            return
+        for n in reversed(list(node.iter_subtree())):
+            for name, aggregate in self._aggregates.iteritems():
+                self._update_aggregate(name, aggregate, n)
+
+    def _add_subtree_aggregates(self, node, refold=True):
+        '''
+        Update the registered aggregates of the ancestors of `node` after the
+        sub-tree rooted at `node` was added to the tree.  The aggregates of
+        the sub-tree itself must be up to date (see
+        `_compute_subtree_aggregates()`).
+        '''
+        if not self._aggregates:
+            return
+        self._propagate_aggregates(node.parent, self._identity_aggregates(),
+                node._aggregates, refold=refold)
+
+    def _remove_subtree_aggregates(self, parent, node, refold=True):
+        '''
+        Update the registered aggregates after the sub-tree rooted at `node`
+        was removed from the children of `parent`.
+        '''
+        if not self._aggregates:
+            return
+        self._propagate_aggregates(parent, node._aggregates,
+                self._identity_aggregates(), refold=refold)
+
+    def _set_item_aggregates(self, node, refold=True):
+        '''
+        Update the registered aggregates after the item of `node` was changed
+        (or modified in place).
+
+        The previous item may have been modified in place, so the previous
+        contribution of the item is not recomputed from it.  Instead, the
+        value of `node` is recomputed from its item and children, and the
+        difference with the cached value is applied to the ancestors.
+        '''
+        if not self._aggregates:
+            return
+        old_values = {}
+        new_values = {}
+        for name, aggregate in self._aggregates.iteritems():
+            if aggregate.inverse is not None:
+                old_values[name] = node._aggregates[name]
+                self._update_aggregate(name, aggregate, node)
+                new_values[name] = node._aggregates[name]
+            elif refold:
+                self._update_aggregate(name, aggregate, node)
+        self._propagate_aggregates(node.parent, old_values, new_values,
+                refold=refold)
+
     @property
     def max_depth(self):
         return self._max_depth
@@ -136,8 +582,8 @@ class NodeTree(object):
     def _reset_index(self):
         self._max_depth = 0
         self._node_to_id_map = {}
-        self._id_to_path_map = []
-        self._node_to_path_map = {}
+        self._id_to_node_map = []
+        self._node_to_position_map = {}
 
     def _reindex(self):
         '''
@@ -145,15 +591,66 @@ class NodeTree(object):
             1) path tuple
             2) linear `Node` index (0-index if tree is flattened)
 
-        This method refreshes the two indexes, along with two mappings:
-            1) from each `Node` instance to the corresponding path tuple
+        This method refreshes the linear index, along with two mappings:
             1) from each `Node` instance to the corresponding linear index
+            2) from each `Node` instance to its position in the children of
+               its parent
+
+        Path tuples are not stored, since their total size grows with the
+        depth of the tree.  Instead, the path of a `Node` is derived on demand
+        from the positions of its ancestors (see `_node_path()`).
+
+        The index is built without recursion, so the depth of the tree is not
+        limited by the interpreter recursion limit:
+
+        >>> depth = 10 ** 6
+        >>> node = top = Node(0)
+        >>> for i in xrange(1, depth): node = node.append_node(Node(i))
+        >>> node_tree = NodeTree(top)
+        >>> node_tree.max_depth == len(node_tree) == depth
+        True
+        >>> node_tree[(0, ) * depth] is node_tree[-1] is node
+        True
+        >>> sum(1 for node in node_tree.iter_nodes()) == depth
+        True
+        >>> node_tree.append_child(node, Node(depth))
+        >>> node_tree._node_path(node_tree[-1]) == (0, ) * (depth + 1)
+        True
+        >>> node_tree == NodeTree(top.copy())
+        True
         '''
         self._reset_index()
-        for index, node_path, node in [i for i in self._iter_children()]:
-            self._node_to_path_map[node] = node_path
-            self._id_to_path_map.append(node_path)
-            self._node_to_id_map[node] = index
+        stack = [(child, i, 1) for i, child in enumerate(self.root.children)]
+        stack.reverse()
+        while stack:
+            node, position, depth = stack.pop()
+            self._node_to_id_map[node] = len(self._id_to_node_map)
+            self._id_to_node_map.append(node)
+            self._node_to_position_map[node] = position
+            self._max_depth = max(self._max_depth, depth)
+            children = node.children
+            for i in xrange(len(children) - 1, -1, -1):
+                stack.append((children[i], i, depth + 1))
+
+    def _node_path(self, node):
+        '''
+        Return the path tuple of `node`, as of the last call to `_reindex()`.
+        The cost is proportional to the depth of `node`.
+
+        >>> node_tree = NodeTree([Node('A'), Node('B')])
+        >>> node_tree.append_child(node_tree[1], Node('B.A'))
+        >>> node_tree.append_child(node_tree[1], Node('B.B'))
+        >>> node_tree._node_path(node_tree[3])
+        (1, 1)
+        >>> node_tree._node_path(node_tree.root)
+        ()
+        '''
+        node_path = []
+        while node is not self.root:
+            node_path.append(self._node_to_position_map[node])
+            node = node.parent
+        node_path.reverse()
+        return tuple(node_path)
 
     def _iter_children(self, node=None):
         '''
@@ -206,56 +703,64 @@ class NodeTree(object):
         relative to `node`:
 
         >>> pprint(list(node_tree._iter_children(node_tree[2, 0]))) #doctest: +ELLIPSIS
-        [(9, (), <...Node object at 0x...>),
-         (10, (0,), <...Node object at 0x...>),
-         (11, (1,), <...Node object at 0x...>)]
+        [(3, (), <...Node object at 0x...>),
+         (4, (0,), <...Node object at 0x...>),
+         (5, (1,), <...Node object at 0x...>)]
 
         Here we see that the `Node` instances in the sub-tree rooted at `node`
         are visited in depth-first pre-visit order.  Note that although the
         path tuple is relative to `node`, the linear index is relative to the
         root of the main tree.
+
+        Each path tuple is built from the path of its parent, so the cost is
+        proportional to the total length of the paths, i.e., quadratic in the
+        depth of a chain-like tree.  Use `iter_nodes()` to traverse very deep
+        trees.
         '''
-        if node is None:
-            node = self.root
-            self._counts = [0]
-            self._depth = -1
-            self._index = 0
-        if node != self.root:
+        if node is None or node is self.root:
+            index = 0
+            # Carry on with the top-level `Node` instances of the tree.
+            stack = [(child, (i, )) for i, child in enumerate(
+                    self.root.children)]
+            stack.reverse()
+        else:
+            index = self._node_to_id_map[node]
             # If we're starting somewhere other than the root of the tree,
-            # start the traversal with the specified `Node`.  Otherwise, we
-            # just carry on with the top-level `Node` instances of the tree.
-            yield self._index, tuple(self._counts[:self._depth + 1]), node
-            self._index += 1
-
-        # We increase the depth level since we are going to traverse the
-        # children of `node`, which are one level deeper.
-        self._depth += 1
-
-        # Keep track of the maximum depth reached for fast access later.
-        self._max_depth = max(self._max_depth, self._depth)
-
-        # We need to keep track of the path tuple for the current `Node`.  We
-        # do this by keeping a running sum of the number of children in the
-        # current sub-tree level.  The sum for each level is stored in a list
-        # at the index corresponding to the tree level.  This list is called
-        # `_counts`.
-        # Here, we add a zero to the `_counts` list if this is the first `Node`
-        # we're visiting at this sub-tree level.
-        while len(self._counts) < self._depth + 1:
-            self._counts.append(0)
-
-        # Perform depth-first traversal by calling `_iter_children()`
-        # recursively on the children.
-        for child in node:
-            for child_node in self._iter_children(child):
-                yield child_node
-            # We need to increment the `Node` count for the current sub-tree
-            # level.
-            self._counts[self._depth] += 1
-        # The depth decreases by one here since we've processed all children of
-        # `node`.
-        self._depth -= 1
-        del self._counts[self._depth + 1:]
+            # start the traversal with the specified `Node`.
+            stack = [(node, ())]
+
+        # Perform depth-first traversal using an explicit stack (rather than
+        # recursion), so the depth of the tree is not limited by the
+        # interpreter recursion limit.  Children are pushed in reverse order,
+        # so they are popped in order.
+        while stack:
+            node, node_path = stack.pop()
+            yield index, node_path, node
+            index += 1
+            children = node.children
+            for i in xrange(len(children) - 1, -1, -1):
+                stack.append((children[i], node_path + (i, )))
+
+    def iter_nodes(self, node=None):
+        '''
+        Iterate through the `Node` instances in the sub-tree rooted at `node`
+        (the whole tree if no `Node` is given) in depth-first pre-visit order,
+        i.e., in the order of the linear index.
+
+        Unlike iterating through the tree itself, no path tuples are built,
+        so the cost of each iteration does not depend on the depth of the
+        tree.
+
+        >>> node_tree = NodeTree([Node('A'), Node('B')])
+        >>> node_tree.append_child(node_tree[0], Node('A.A'))
+        >>> [node.item for node in node_tree.iter_nodes()]
+        ['A', 'A.A', 'B']
+        >>> [node.item for node in node_tree.iter_nodes(node_tree[0])]
+        ['A', 'A.A']
+        '''
+        if node is None or node is self.root:
+            return iter(self._id_to_node_map)
+        return node.iter_subtree()
 
     def _get_node(self, parent, node_path):
         '''
@@ -308,11 +813,12 @@ class NodeTree(object):
         Here we can see that the second grandchild of `Node [2, 0]` is returned,
         as expected.
         '''
-        if len(node_path) > 1:
-            return self._get_node(parent[node_path[0]],
-                    node_path[1:])
-        else:
-            return parent[node_path[0]]
+        if not node_path:
+            raise IndexError, 'Empty node path'
+        node = parent
+        for i in node_path:
+            node = node[i]
+        return node
 
     def __iter__(self):
         '''
@@ -322,8 +828,8 @@ class NodeTree(object):
         Each iteration yields the following tuple:
             (path tuple, `Node` reference)
         '''
-        for i in range(len(self)):
-            yield self._id_to_path_map[i], self[i]
+        for index, node_path, node in self._iter_children():
+            yield node_path, node
 
     def __getitem__(self, key):
         '''
@@ -338,10 +844,13 @@ class NodeTree(object):
             return self._get_node(self.root, key)
         except TypeError:
             # The key does have a length, so interpret it as a linear index.
-            return self._get_node(self.root, self._id_to_path_map[key])
+            return self._id_to_node_map[key]
 
     def __len__(self):
-        return len(self._id_to_path_map)
+        return len(self._id_to_node_map)
+
+    def on_patched(self, script):
+        logging.debug('[on_patched] %d operations' % len(script))
 
     def on_ungrouped(self, root_paths):
         logging.debug('[on_ungrouped] root_paths=%s' % root_paths)
@@ -361,36 +870,60 @@ class NodeTree(object):
     def on_node_removed(self, *args, **kwargs):
         logging.debug('[on_node_removed] args=%s kwargs=%s' % (args, kwargs))
 
+    def on_node_updated(self, node_path, item):
+        logging.debug('[on_node_updated] node_path=%s item=%s' % (node_path,
+                item))
+
+    def _on_patched(self, script):
+        self._reindex()
+        self._publish('patched', None, tuple(script))
+        self.on_patched(script)
+
     def _on_ungrouped(self, root_paths):
         self._reindex()
+        self._publish('ungrouped', None, tuple(root_paths))
         self.on_ungrouped(root_paths)
 
     def _on_grouped(self, parent_path, children_paths):
         self._reindex()
+        self._publish('grouped', parent_path, children_paths)
         self.on_grouped(parent_path, children_paths)
 
-    def _on_node_inserted(self, *args, **kwargs):
+    def _on_node_inserted(self, node_path, node):
         self._reindex()
         if not self._ungroup_in_progress and not self._group_in_progress:
-            self.on_node_inserted(*args, **kwargs)
+            if self._feeds:
+                self._publish('inserted', node_path, node.copy())
+            self.on_node_inserted(node_path, node)
 
-    def _on_node_appended(self, *args, **kwargs):
+    def _on_node_appended(self, node):
         self._reindex()
         if not self._ungroup_in_progress and not self._group_in_progress:
-            self.on_node_appended(*args, **kwargs)
+            if self._feeds:
+                self._publish('appended', self._node_path(node),
+                        node.copy())
+            self.on_node_appended(node)
 
-    def _on_node_removed(self, *args, **kwargs):
+    def _on_node_updated(self, node_path, item):
+        self._publish('updated', node_path, item)
+        self.on_node_updated(node_path, item)
+
+    def _on_node_removed(self, node_path, node_tree):
         self._reindex()
         if not self._ungroup_in_progress and not self._group_in_progress:
-            self.on_node_removed(*args, **kwargs)
+            if self._feeds:
+                # The caller may re-insert the returned sub-tree, so publish a
+                # separate copy.
+                self._publish('removed', node_path,
+                        node_tree.root.children[0].get_tree())
+            self.on_node_removed(node_path, node_tree)
 
     def append_node(self, node):
         '''
         Append `node` to the list of top-level `Node` instances in the tree.
         '''
         if self.root.children:
-            sibling_path = (self._node_to_path_map[self[-1]][0], )
-            self.insert_after(self[sibling_path], node)
+            self.insert_after(self.root.children[-1], node)
         else:
             self.append_child(self.root, node)
         return node
@@ -400,17 +933,36 @@ class NodeTree(object):
         Append `node` to the children of `parent`, where `node` is either a
         `Node` instance or a `NodeTree` instance with a single top-level
         `Node`.
+
+        The aggregates of the sub-tree rooted at `node` are computed before
+        `node` is linked into the tree, so the tree is left unchanged if an
+        aggregate fails:
+
+        >>> node_tree = NodeTree([Node('A')])
+        >>> node_tree.enable_hashing(digest=hash)
+        >>> node_tree.append_child(node_tree[0], Node(['x']))
+        Traceback (most recent call last):
+            ...
+        TypeError: unhashable type: 'list'
+        >>> len(node_tree), len(node_tree[0])
+        (1, 0)
         '''
+        self._compute_subtree_aggregates(node)
         node = parent.append_node(node)
+        self._add_subtree_aggregates(node)
         self._on_node_appended(node)
 
     def _insert_relative(self, insert_func, sibling, node):
         '''
         Common code for inserting `node` either before or after `sibling`.
         '''
+        self._compute_subtree_aggregates(node)
         position = insert_func(sibling, node)
-        sibling_path = self._node_to_path_map[sibling]
-        self._on_node_inserted(sibling_path[:-1] + (position, ), node)
+        self._add_subtree_aggregates(node)
+        # The positions of the ancestors of `node` are not affected by the
+        # insertion.
+        self._on_node_inserted(self._node_path(node.parent) + (position, ),
+                node)
 
     def insert_before(self, sibling, node):
         '''
@@ -456,13 +1008,305 @@ class NodeTree(object):
         Return `NodeTree` instance with a single top-level `Node`, containing
         the full removed sub-tree.
         '''
-        node_path = self._node_to_path_map[node]
-        node.parent.remove_node(node)
+        node_path = self._node_path(node)
+        parent = node.parent
+        parent.remove_node(node)
+        self._remove_subtree_aggregates(parent, node)
         node_tree = node.get_tree()
         self._on_node_removed(node_path, node_tree)
         return node_tree
 
+    def _key_to_node_map(self, key):
+        key_to_node = {}
+        for node in self._id_to_node_map:
+            node_key = key(node.item)
+            if node_key in key_to_node:
+                raise ValueError, 'Duplicate key: %r' % (node_key, )
+            key_to_node[node_key] = node
+        return key_to_node
+
+    def diff(self, other, key=_identity):
+        '''
+        Return an edit script (list of operations) that transforms this tree
+        into the `NodeTree` `other`, where `Node` instances are matched between
+        the two trees by `key(node.item)`.  Keys must be unique within each
+        tree, and must not be `None`.
+
+        The script contains the following operations, in order:
+
+            ('insert', parent_key, after_key, item)
+                Insert a new `Node` with `item` as a child of the `Node` with
+                key `parent_key`, directly after its child with key
+                `after_key`.
+            ('move', node_key, parent_key, after_key)
+                Move the `Node` with key `node_key` (along with all
+                descendents) to the same position as for an insert.
+            ('update', node_key, item)
+                Replace the item of the `Node` with key `node_key`.
+            ('remove', node_key)
+                Remove the `Node` with key `node_key`, along with all
+                descendents.
+
+        `parent_key` is `None` for a top-level `Node`, and `after_key` is
+        `None` for a first child.
+
+        For each parent, the children that keep their parent and whose
+        relative order forms a longest increasing subsequence are left in
+        place, and only the other children are moved.  The cost is
+        O(n log n) in the size of the trees.
+
+        >>> a = NodeTree([Node('A'), Node('B'), Node('C')])
+        >>> a.append_child(a[1], Node('B.A'))
+        >>> b = a.copy()
+        >>> removed = b.remove(b[0])
+        >>> b.append_child(b[-1], Node('C.A'))
+        >>> b.append_child(b[0], b.remove(b[(1, )])[0])
+        >>> script = a.diff(b)
+        >>> pprint(script)  #doctest: +NORMALIZE_WHITESPACE
+        [('move', 'C', 'B', 'B.A'),
+         ('insert', 'C', None, 'C.A'),
+         ('remove', 'A')]
+        >>> a.apply_patch(script)
+        >>> print a  #doctest: +NORMALIZE_WHITESPACE
+        [ 0] (0,) Node(item=B)
+        [ 1] (0, 0) Node(item=B.A)
+        [ 2] (0, 1) Node(item=C)
+        [ 3] (0, 1, 0) Node(item=C.A)
+
+        Moving a single `Node` yields a single `move` operation:
+
+        >>> a = NodeTree([Node(i) for i in range(1000)])
+        >>> b = a.copy()
+        >>> b.append_node(b.remove(b[0])[0])  #doctest: +ELLIPSIS
+        <...>
+        >>> a.diff(b)
+        [('move', 0, None, 999)]
+        '''
+        # Index the `Node` instances of this tree by key.  The root is
+        # represented by `None`.
+        old = {}
+        old_keys = []
+        for parent in self.root.iter_subtree():
+            parent_key = None if parent is self.root else key(parent.item)
+            for position, child in enumerate(parent.children):
+                child_key = key(child.item)
+                if child_key in old:
+                    raise ValueError, 'Duplicate key: %r' % (child_key, )
+                old[child_key] = (parent_key, position, child.item)
+                old_keys.append(child_key)
+
+        # Visit `other` in depth-first pre-visit order, so each parent is in
+        # place before its children are inserted or moved.
+        script = []
+        other_keys = set()
+        pending = {}
+        for node in other.root.iter_subtree():
+            if node is other.root:
+                node_key = None
+            else:
+                node_key, parent_key, after_key, stable = pending.pop(node)
+                if node_key not in old:
+                    script.append(('insert', parent_key, after_key,
+                            node.item))
+                elif not stable:
+                    script.append(('move', node_key, parent_key, after_key))
+                if node_key in old and old[node_key][2] != node.item:
+                    script.append(('update', node_key, node.item))
+            child_keys = []
+            for child in node.children:
+                child_key = key(child.item)
+                if child_key in other_keys:
+                    raise ValueError, 'Duplicate key: %r' % (child_key, )
+                other_keys.add(child_key)
+                child_keys.append(child_key)
+            stable = _stable_children(node_key, child_keys, old)
+            after_key = None
+            for child, child_key in zip(node.children, child_keys):
+                pending[child] = (child_key, node_key, after_key,
+                        child_key in stable)
+                after_key = child_key
+
+        # Descendents of a removed `Node` are removed along with it, so only
+        # emit an operation for the top-most removed `Node` instances.
+        for node_key in old_keys:
+            parent_key = old[node_key][0]
+            if node_key not in other_keys and (parent_key is None or
+                    parent_key in other_keys):
+                script.append(('remove', node_key))
+        return script
+
+    def apply_patch(self, script, key=_identity):
+        '''
+        Apply an edit script, as returned by `diff()` (using the same `key`),
+        to this tree.  All operations are applied as a single mutation, so the
+        tree is only reindexed once, and `on_patched()` is called (instead of
+        the callback for each inserted/removed `Node`).
+
+        The list of children of each affected parent is rebuilt once, so the
+        cost of an operation does not depend on the number of siblings.
+
+        The script is checked before the tree is modified, so an invalid
+        script raises a `ValueError` and leaves the tree unchanged:
+
+        >>> node_tree = NodeTree([Node('A')])
+        >>> node_tree.append_child(node_tree[0], Node('B'))
+        >>> node_tree.register_aggregate('count', Aggregate.count())
+        >>> node_tree.apply_patch([('move', 'A', 'B', None)])
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid edit script: a `Node` is placed in its own sub-tree, or in a removed sub-tree
+        >>> len(node_tree), node_tree.aggregate('count')
+        (2, 2)
+        '''
+        key_to_node = self._key_to_node_map(key)
+        key_to_node[None] = self.root
+
+        # Collect the operations, grouped by parent.  `attached` maps each
+        # parent to the `Node` instances placed directly after each child
+        # (`None` for the first position), in script order.  `new_parents`
+        # maps each inserted or moved `Node` to its new parent.
+        detached = {}
+        attached = {}
+        new_parents = {}
+        removed = set()
+        added = []
+        updated = []
+        for operation in script:
+            op = operation[0]
+            if op == 'insert':
+                parent_key, after_key, item = operation[1:]
+                item_key = key(item)
+                if item_key in key_to_node:
+                    raise ValueError, 'Duplicate key: %r' % (item_key, )
+                node = self.node_class(item)
+                key_to_node[item_key] = node
+                for name, aggregate in self._aggregates.iteritems():
+                    if aggregate.inverse is not None:
+                        node._aggregates[name] = aggregate.leaf(item)
+            elif op in ('move', 'remove'):
+                node_key = operation[1]
+                node = key_to_node[node_key]
+                # The root and new `Node` instances have no parent.
+                if node.parent is None or node in new_parents or \
+                        node in removed:
+                    raise ValueError, 'Invalid edit script: %r cannot be '\
+                            'moved or removed' % (node_key, )
+                detached.setdefault(node.parent, []).append(node)
+                if op == 'remove':
+                    removed.add(node)
+                    continue
+                parent_key, after_key = operation[2:]
+            elif op == 'update':
+                node_key, item = operation[1:]
+                updated.append((key_to_node[node_key], item))
+                continue
+            else:
+                raise ValueError, 'Invalid operation: %r' % (op, )
+            parent = key_to_node[parent_key]
+            new_parents[node] = parent
+            added.append(node)
+            anchor = None if after_key is None else key_to_node[after_key]
+            attached.setdefault(parent, {}).setdefault(anchor, []).append(
+                    node)
+
+        # Check that each inserted or moved `Node` is still connected to the
+        # root once the script is applied, and record its new depth.  Each
+        # `Node` is only visited once.
+        depths = {self.root: 0}
+        for node in new_parents:
+            chain = []
+            visited = set()
+            while node not in depths:
+                if node in visited or node in removed:
+                    raise ValueError, 'Invalid edit script: a `Node` is '\
+                            'placed in its own sub-tree, or in a removed '\
+                            'sub-tree'
+                chain.append(node)
+                visited.add(node)
+                node = new_parents.get(node, node.parent)
+            depth = depths[node]
+            for node in reversed(chain):
+                depth += 1
+                depths[node] = depth
+
+        # Compute the new list of children of each affected parent.
+        new_children = {}
+        for parent, nodes in detached.iteritems():
+            nodes = set(nodes)
+            new_children[parent] = [child for child in parent.children
+                    if child not in nodes]
+        for parent, anchors in attached.iteritems():
+            children = new_children.get(parent, parent.children)
+            count = len(children) + sum(len(nodes)
+                    for nodes in anchors.itervalues())
+            # A `Node` placed after a child goes before the `Node` instances
+            # placed earlier after the same child, so the `Node` instances of
+            # each anchor are pushed in script order, and popped in reverse.
+            stack = children[::-1]
+            stack.extend(anchors.get(None, ()))
+            children = []
+            while stack:
+                node = stack.pop()
+                children.append(node)
+                stack.extend(anchors.get(node, ()))
+            if len(children) != count:
+                raise ValueError, 'Invalid edit script: a `Node` is placed '\
+                        'after a `Node` that is not a sibling'
+            new_children[parent] = children
+
+        # Aggregates with an `inverse` are updated with deltas along the
+        # ancestor path of each change, before detaching and after attaching.
+        # The other aggregates are refolded once, at the end.  Each detached
+        # `Node` is unlinked from its parent right away, so the deltas of its
+        # detached descendents stop at it.
+        for parent, nodes in detached.iteritems():
+            for node in nodes:
+                self._remove_subtree_aggregates(parent, node, refold=False)
+                node.parent = None
+        for parent, children in new_children.iteritems():
+            parent.children[:] = children
+            for child in children:
+                child.parent = parent
+
+        dirty = detached.keys()
+        if self._aggregates:
+            # Each inserted or moved `Node` only holds the values of its own
+            # sub-tree, excluding inserted or moved descendents, which must be
+            # added after it.
+            added.sort(key=depths.get)
+            for node in added:
+                self._add_subtree_aggregates(node, refold=False)
+                dirty.append(node)
+
+        for node, item in updated:
+            node.item = item
+            self._set_item_aggregates(node, refold=False)
+            dirty.append(node)
+
+        if self._aggregates:
+            self._refold_aggregates(dirty)
+        self._on_patched(script)
+
     def copy(self):
+        '''
+        Return a deep copy of the tree.  Trees of any depth may be copied (and
+        pickled), since `Node` instances are copied without recursion.
+
+        >>> import pickle, sys
+        >>> depth = 2 * sys.getrecursionlimit()
+        >>> node = top = Node(0)
+        >>> for i in xrange(1, depth): node = node.append_node(Node(i))
+        >>> node_tree = NodeTree(top)
+        >>> node_tree.max_depth == depth
+        True
+        >>> node_tree[(0, ) * depth].item == depth - 1
+        True
+        >>> node_tree.copy() == node_tree
+        True
+        >>> data = pickle.dumps(node_tree, pickle.HIGHEST_PROTOCOL)
+        >>> pickle.loads(data) == node_tree
+        True
+        '''
         return copy.deepcopy(self)
 
 
@@ -480,7 +1324,10 @@ class Node(object):
         c) append_node(child)
             Insert the provided node at the end of the list of children for
             `self`
-        d) remove_node(node)
+        d) insert_node(position, child)
+            Insert the provided node at `position` in the list of children for
+            `self`
+        e) remove_node(node)
             Remove specified node from the children of `self`.
     '''
     tree_class = NodeTree
@@ -489,6 +1336,8 @@ class Node(object):
         self.parent = None
         self.item = item
         self.children = []
+        # Cached values of aggregates registered on the containing `NodeTree`.
+        self._aggregates = {}
 
     def __str__(self):
         return 'Node(item=%s)' % (self.item, )
@@ -519,6 +1368,16 @@ class Node(object):
         '''
         child.parent = self
         self.children.append(child)
+        return child
+
+    def insert_node(self, position, child):
+        '''
+        Insert the provided node at `position` in the list of children for
+        `self`
+        '''
+        child.parent = self
+        self.children.insert(position, child)
+        return position
 
     def remove_node(self, node):
         '''
@@ -543,6 +1402,110 @@ class Node(object):
     def get_tree(self):
         return self.tree_class(self.copy())
 
+    def iter_subtree(self):
+        '''
+        Iterate through `self` and all descendents of `self` in depth-first
+        pre-visit order.
+        '''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def _attributes(self):
+        '''
+        Return the attributes of `self`, except for the links to the parent
+        and children.
+        '''
+        attributes = self.__dict__.copy()
+        attributes.pop('parent', None)
+        attributes.pop('_parent', None)
+        del attributes['children']
+        return attributes
+
+    def __copy__(self):
+        '''
+        Return a shallow copy of `self`, sharing the parent, children and item
+        of `self`.  Use `copy.deepcopy()` or `copy()` to copy the sub-tree
+        rooted at `self`.
+
+        >>> import copy
+        >>> node = Node('A')
+        >>> child = node.append_node(Node('A.A'))
+        >>> copy.copy(node).children[0] is child
+        True
+        >>> node_copy = copy.deepcopy(node)
+        >>> node_copy.children[0] is child
+        False
+        >>> node_copy.children[0].parent is node_copy
+        True
+        '''
+        cls = self.__class__
+        node = cls.__new__(cls)
+        node.__dict__.update(self.__dict__)
+        return node
+
+    def __deepcopy__(self, memo):
+        '''
+        Return a deep copy of the sub-tree rooted at `self`.  The `Node`
+        instances are copied in depth-first pre-visit order (rather than by
+        recursion), so the depth of the tree is not limited by the
+        interpreter recursion limit.
+
+        Note that the parent of `self` is not copied.
+        '''
+        for node in self.iter_subtree():
+            cls = node.__class__
+            node_copy = cls.__new__(cls)
+            memo[id(node)] = node_copy
+            node_copy.__dict__.update(copy.deepcopy(node._attributes(),
+                    memo))
+            node_copy.children = []
+            if node is self:
+                node_copy.parent = None
+            else:
+                parent_copy = memo[id(node.parent)]
+                node_copy.parent = parent_copy
+                parent_copy.children.append(node_copy)
+        return memo[id(self)]
+
+    def __getstate__(self):
+        '''
+        Return the state of the sub-tree rooted at `self` as a flat list of
+        `(class, attributes, parent position)` tuples, in depth-first
+        pre-visit order, where the parent position is the position of the
+        parent in the list.  This way, pickling does not recurse through the
+        tree, so the depth of the tree is not limited by the interpreter
+        recursion limit.
+
+        Note that the parent of `self` is not part of the state.
+        '''
+        positions = {}
+        nodes = []
+        for position, node in enumerate(self.iter_subtree()):
+            positions[node] = position
+            parent_position = positions.get(node.parent) if position else None
+            nodes.append((node.__class__, node._attributes(),
+                    parent_position))
+        return nodes
+
+    def __setstate__(self, nodes):
+        created = []
+        for cls, attributes, parent_position in nodes:
+            if created:
+                node = cls.__new__(cls)
+            else:
+                node = self
+            node.__dict__.update(attributes)
+            node.parent = None
+            node.children = []
+            if parent_position is not None:
+                parent = created[parent_position]
+                node.parent = parent
+                parent.children.append(node)
+            created.append(node)
+
     def _copy_single(self):
         '''
         Return a shallow copy of `self` (no children are set).
@@ -551,19 +1514,365 @@ class Node(object):
 
     def copy(self):
         '''
-        Return a deep copy of `self`, recursively copying all all ancestors of
-        `self`.  Note that although all `Node` instances are copied by value
+        Return a deep copy of `self`, copying all descendents of `self`
+        (without recursion).  Note that although all `Node` instances are copied by value
         here, all `Node.item` values are only copied by reference (which makes
         sense, since you might want to reference the same object in multiple
         tree structures).
         '''
         new_node = self._copy_single()
-        new_node.children = [child.copy() for child in self.children]
-        for child in new_node:
-            child.parent = new_node
+        stack = [(self, new_node)]
+        while stack:
+            node, node_copy = stack.pop()
+            for child in node.children:
+                child_copy = child._copy_single()
+                child_copy.parent = node_copy
+                node_copy.children.append(child_copy)
+                stack.append((child, child_copy))
         return new_node
 
 
+class WeakParentNode(Node):
+    '''
+    A `Node` that holds a weak reference to its parent (the parent still holds
+    a strong reference to each of its children).  Trees of `WeakParentNode`
+    instances contain no reference cycles, so a tree or sub-tree is freed by
+    reference counting as soon as it is no longer referenced, rather than by
+    the cyclic garbage collector.
+
+    Note that a `WeakParentNode` does not keep its ancestors alive, so
+    `parent` becomes `None` once the ancestors are no longer referenced
+    (e.g., when only a `Node` is kept from a discarded `NodeTree`).
+
+    >>> node_tree = WeakParentNodeTree([WeakParentNode('A')])
+    >>> node_tree.append_child(node_tree[0], WeakParentNode('A.A'))
+    >>> node = node_tree[1]
+    >>> print node.parent
+    Node(item=A)
+    >>> del node_tree
+    >>> print node.parent
+    None
+    '''
+    def _get_parent(self):
+        parent = self._parent
+        if parent is not None:
+            parent = parent()
+        return parent
+
+    def _set_parent(self, parent):
+        if parent is not None:
+            parent = weakref.ref(parent)
+        self._parent = parent
+
+    parent = property(_get_parent, _set_parent)
+
+
+class WeakParentNodeTree(NodeTree):
+    '''
+    A `NodeTree` using `WeakParentNode` instances for the nodes it creates
+    (see `WeakParentNode`).  The nodes added to the tree should also be
+    `WeakParentNode` instances.
+    '''
+    node_class = WeakParentNode
+
+
+NodeTree.node_class = Node
+WeakParentNode.tree_class = WeakParentNodeTree
+
+
+class Change(namedtuple('Change', 'kind path data')):
+    '''
+    Record describing a single mutation of a `NodeTree`.  `data` is always a
+    snapshot taken at the time of the mutation (e.g., a copy of the inserted
+    `Node`), so it is not affected by later mutations.  `kind` is one of:
+
+        inserted
+            `path` is the path of the inserted `Node`; `data` is a copy of the
+            `Node` (along with its descendents).
+        appended
+            `path` is the path of the appended `Node`; `data` is a copy of the
+            `Node` (along with its descendents).
+        updated
+            `path` is the path of the `Node` whose item was replaced using
+            `NodeTree.set_item()`; `data` is the new item.
+        removed
+            `path` is the former path of the removed `Node`; `data` is a
+            `NodeTree` containing a copy of the removed sub-tree.
+        grouped
+            `path` is the path of the group root; `data` is the tuple of paths
+            (before grouping) of the `Node` instances added to the group.
+        ungrouped
+            `path` is `None`; `data` is the tuple of paths of the group roots.
+        patched
+            `path` is `None`; `data` is the edit script passed to
+            `NodeTree.apply_patch()`, as a tuple.
+        reset
+            Buffered records were coalesced after an overflow.  `path` and
+            `data` are `None`; the consumer must resynchronize from the tree
+            itself.
+    '''
+    __slots__ = ()
+
+
+class ChangeFeedOverflow(Exception):
+    pass
+
+
+class ChangeFeed(object):
+    '''
+    An instance of this class is a subscription to the mutations of a
+    `NodeTree` (see `NodeTree.changes()`).
+
+    Each mutation appends a `Change` record to a buffer holding at most
+    `maxlen` records, without ever blocking the mutation.  Records can be
+    consumed from any thread using:
+        get(block=True, timeout=None)
+            Return the next record, waiting for one if `block` is `True`.
+            Raise `IndexError` if no record is available.
+
+        drain()
+            Return a list of all buffered records, without waiting.
+
+        iteration
+            Yield records as they arrive, until the feed is closed.
+
+    When the buffer is full, `policy` selects how the feed applies
+    backpressure:
+        coalesce
+            Replace all buffered records by a single `reset` record.  No more
+            records are buffered until the `reset` record is consumed, so a
+            burst of mutations costs a slow consumer a single resync.
+
+        drop_oldest
+            Discard the oldest buffered record.
+
+        drop_newest
+            Discard the new record.
+
+        error
+            Close the feed, and raise `ChangeFeedOverflow` in the consumer
+            once the buffered records have been consumed.
+    '''
+    policies = ('coalesce', 'drop_oldest', 'drop_newest', 'error')
+
+    def __init__(self, node_tree, maxlen=1024, policy='coalesce'):
+        if policy not in self.policies:
+            raise ValueError, 'Invalid policy: %s.  Must be one of %s.' % (
+                    policy, ', '.join(self.policies))
+        if maxlen < 1:
+            raise ValueError, 'maxlen must be at least 1'
+        self.node_tree = node_tree
+        self.maxlen = maxlen
+        self.policy = policy
+        self.closed = False
+        self.overflowed = False
+        self._buffer = deque()
+        self._condition = threading.Condition()
+
+    def _put(self, change):
+        with self._condition:
+            if self.closed:
+                return
+            if self._buffer and self._buffer[-1].kind == 'reset':
+                # The consumer must resync anyways, so drop further records.
+                return
+            if len(self._buffer) >= self.maxlen:
+                if self.policy == 'coalesce':
+                    self._buffer.clear()
+                    change = Change('reset', None, None)
+                elif self.policy == 'drop_oldest':
+                    self._buffer.popleft()
+                elif self.policy == 'drop_newest':
+                    return
+                else:
+                    self.overflowed = True
+                    self._close()
+                    return
+            self._buffer.append(change)
+            self._condition.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._condition:
+            if block and not self._buffer and not self.closed:
+                self._condition.wait(timeout)
+            if self._buffer:
+                return self._buffer.popleft()
+            if self.overflowed:
+                raise ChangeFeedOverflow, 'Change buffer overflowed '\
+                        '(maxlen=%d)' % self.maxlen
+            raise IndexError, 'No change available'
+
+    def drain(self):
+        with self._condition:
+            changes = list(self._buffer)
+            self._buffer.clear()
+        return changes
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except IndexError:
+                if self.closed:
+                    return
+
+    def _close(self):
+        self.closed = True
+        try:
+            self.node_tree._feeds.remove(self)
+        except ValueError:
+            pass
+        self._condition.notify_all()
+
+    def close(self):
+        '''
+        Unsubscribe from the tree.  Records that are already buffered can
+        still be consumed.
+        '''
+        with self._condition:
+            self._close()
+
+
+def _longest_increasing_subsequence(values):
+    '''
+    Return the positions (in increasing order) of a longest strictly
+    increasing subsequence of `values`, in O(n log n).
+
+    >>> _longest_increasing_subsequence([3, 0, 1, 4, 2])
+    [1, 2, 4]
+    '''
+    # `tails[j]` is the smallest value ending an increasing subsequence of
+    # length `j + 1`, found at position `tail_positions[j]`.
+    tails = []
+    tail_positions = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        j = bisect.bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_positions.append(i)
+        else:
+            tails[j] = value
+            tail_positions[j] = i
+        if j:
+            previous[i] = tail_positions[j - 1]
+    positions = []
+    i = tail_positions[-1] if tail_positions else None
+    while i is not None:
+        positions.append(i)
+        i = previous[i]
+    positions.reverse()
+    return positions
+
+
+def _stable_children(parent_key, child_keys, old):
+    '''
+    Return the set of keys in `child_keys` that `NodeTree.diff()` leaves in
+    place, i.e., a largest set of children that already have `parent_key` as
+    their parent, and are already in order.
+    '''
+    candidates = [(old[child_key][1], child_key) for child_key in child_keys
+            if child_key in old and old[child_key][0] == parent_key]
+    positions = _longest_increasing_subsequence([position for position,
+            child_key in candidates])
+    return set(candidates[i][1] for i in positions)
+
+
+def _merkle_combine(a, b):
+    return hash((a, b))
+
+
+def _hash_leaf(key, item):
+    return hash(key(item))
+
+
+def _digest_leaf(digest, key, item):
+    return digest(key(item)).digest()
+
+
+def _digest_combine(digest, a, b):
+    return digest(a + b).digest()
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    return max(a, b)
+
+
+class Aggregate(object):
+    '''
+    An instance of this class describes a monoid aggregate that may be
+    registered on a `NodeTree` using `NodeTree.register_aggregate()`.
+
+    The value of the aggregate for a `Node` is computed by folding the value
+    of `leaf(node.item)` together with the values of all children (in order)
+    using `combine`.  `identity` is the value of the aggregate for an empty
+    tree, i.e., `combine(identity, x) == x`.
+
+    If `combine` is commutative and can be undone, `inverse` should be given,
+    such that `combine(inverse(a, b), b) == a`.  Changes are then applied to
+    the ancestors of a mutated `Node` as deltas, so an update costs O(depth).
+    Otherwise, each ancestor is recomputed from all of its children, so an
+    update costs O(depth * number of children).
+
+    Common aggregates can be created using the following class methods:
+        count()
+            Number of `Node` instances in the sub-tree (with `inverse`).
+
+        sum(key=None)
+            Sum of `key(node.item)` over all `Node` instances in the sub-tree
+            (with `inverse`).
+
+        max(key=None)
+            Maximum of `key(node.item)` over all `Node` instances in the
+            sub-tree (`None` for an empty tree).
+
+        merkle(digest=hashlib.sha1, key=None)
+            Hash of the items of all `Node` instances in the sub-tree, along
+            with the structure of the sub-tree (see
+            `NodeTree.enable_hashing()`).
+    '''
+    def __init__(self, leaf, combine, identity=None, inverse=None):
+        self.leaf = leaf
+        self.combine = combine
+        self.identity = identity
+        self.inverse = inverse
+
+    @classmethod
+    def count(cls):
+        return cls(_one, operator.add, 0, operator.sub)
+
+    @classmethod
+    def sum(cls, key=None):
+        if key is None:
+            key = _identity
+        return cls(key, operator.add, 0, operator.sub)
+
+    @classmethod
+    def max(cls, key=None):
+        if key is None:
+            key = _identity
+        return cls(key, _max, None)
+
+    @classmethod
+    def merkle(cls, digest=hashlib.sha1, key=None):
+        if digest is hash:
+            if key is None:
+                return cls(hash, _merkle_combine, hash(()))
+            return cls(functools.partial(_hash_leaf, key), _merkle_combine,
+                    hash(()))
+        if key is None:
+            key = repr
+        return cls(functools.partial(_digest_leaf, digest, key),
+                functools.partial(_digest_combine, digest), digest('').digest())
+
+
 _node_tree_dot_template_str = '''\
 digraph G {
 {{ extra }}
@@ -575,12 +1884,14 @@ digraph G {
 
 def node_tree_to_dot(node_tree, extra_dot=''):
     template = Template(_node_tree_dot_template_str)
+    depths = {node_tree.root: 0}
     with closing(StringIO.StringIO()) as sio:
-        for node_path, node in node_tree:
+        for node in node_tree.iter_nodes():
+                depths[node] = depths[node.parent] + 1
                 print >> sio, '%s [ label=<<table border="0"><tr><td><b>[%s]</b>:</td><td><i>%s</i></td></tr></table>> ];' % (
                         node_tree._node_to_id_map[node],
                                 node_tree._node_to_id_map[node], node.item)
-                print >> sio, '    ' * (len(node_path) - 1),
+                print >> sio, '    ' * (depths[node] - 1),
                 try:
                     if node.parent is not node_tree.root:
                         print >> sio, '%s->%s;' % (node_tree._node_to_id_map[